@@ -17,4 +17,7 @@ setup(name='txdarn',
                         'eliot',
                         'six',
                         'autobahn>=0.17.1',
-                        'automat>=0.3.0'])
+                        # txdarn.protocol reads automat's private
+                        # transition table, so only allow the releases
+                        # it's been checked against
+                        'automat>=0.6.0,<=25.4.16'])
@@ -1,3 +1,6 @@
+import codecs
+import math
+import re
 import sys
 import six
 import json
@@ -7,19 +10,181 @@ if not (2 <= sys.version_info.major <= 3):
     raise RuntimeError("Unknown Python version!")
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
 if six.PY3:
     def asJSON(*args, **kwargs):
         return json.dumps(*args, **kwargs).encode(ENCODING)
 
-    def fromJSON(s, *args, **kwargs):
+    def _stdlibFromJSON(s, *args, **kwargs):
         return json.loads(s.decode(ENCODING), *args, **kwargs)
 else:
     def asJSON(*args, **kwargs):
         return json.dumps(*args, **kwargs)
 
-    def fromJSON(*args, **kwargs):
+    def _stdlibFromJSON(*args, **kwargs):
         return json.loads(*args, **kwargs)
 
+
+def _stdlibAsCompactJSON(obj, cls=None):
+    return asJSON(obj, separators=(',', ':'), cls=cls)
+
+
+# orjson and ujson are optional accelerators.  Both are only used
+# when the caller hasn't asked for a custom JSONEncoder or
+# JSONDecoder, because neither understands json's cls protocol.
+if orjson is not None:
+    def _escapeNonASCII(error):
+        '''A codecs error handler that replaces the characters ASCII
+        can't encode with JSON \\u escapes, as json's ensure_ascii
+        does.
+
+        '''
+        escapes = []
+        for char in error.object[error.start:error.end]:
+            codePoint = ord(char)
+            if codePoint > 0xffff:
+                # a surrogate pair
+                codePoint -= 0x10000
+                escapes.append(u'\\u%04x\\u%04x' % (
+                    0xd800 | (codePoint >> 10),
+                    0xdc00 | (codePoint & 0x3ff)))
+            else:
+                escapes.append(u'\\u%04x' % codePoint)
+        return u''.join(escapes), error.end
+
+    codecs.register_error('txdarn.escapeNonASCII', _escapeNonASCII)
+
+    def _hasNonFiniteFloat(obj):
+        '''Return True if obj, or anything in it that orjson will
+        serialize, is NaN or infinite.
+
+        '''
+        if type(obj) is float:
+            return not math.isfinite(obj)
+        if isinstance(obj, dict):
+            obj = obj.values()
+        elif not isinstance(obj, (list, tuple)):
+            return False
+        return any(map(_hasNonFiniteFloat, obj))
+
+    def asCompactJSON(obj, cls=None):
+        '''Serialize obj as JSON bytes without any insignificant
+        whitespace.
+
+        '''
+        if cls is None:
+            try:
+                encoded = orjson.dumps(obj)
+            except TypeError:
+                # e.g., non-string keys or integers wider than 64
+                # bits.  Let json decide what to do with them.
+                pass
+            else:
+                # orjson writes NaN and the infinities as null, where
+                # json writes NaN and Infinity.
+                if not _hasNonFiniteFloat(obj):
+                    # orjson emits raw UTF-8, but SockJS requires that
+                    # non-ASCII characters be escaped.  Non-ASCII
+                    # characters only appear inside strings, so
+                    # escaping them leaves valid JSON.
+                    if not encoded.isascii():
+                        encoded = encoded.decode('utf-8').encode(
+                            'ascii', 'txdarn.escapeNonASCII')
+                    # json escapes DEL too
+                    if b'\x7f' in encoded:
+                        encoded = encoded.replace(b'\x7f', b'\\u007f')
+                    return encoded
+        return _stdlibAsCompactJSON(obj, cls)
+
+    # orjson rejects some JSON that json accepts: lone surrogate
+    # escapes (which JSON.stringify can produce), NaN, the infinities
+    # and numbers too large for a double.  Only input that might be
+    # one of those is worth parsing again.
+    _mayBeStdlibOnlyJSON = re.compile(
+        br'\\u[dD][89a-fA-F]|NaN|Infinity|[0-9][eE]|[0-9]{309}').search
+
+    def _fastFromJSON(s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            if _mayBeStdlibOnlyJSON(s) is None:
+                raise
+            return _stdlibFromJSON(s)
+elif ujson is not None:
+    def asCompactJSON(obj, cls=None):
+        '''Serialize obj as JSON bytes without any insignificant
+        whitespace.
+
+        '''
+        if cls is None:
+            encoded = ujson.dumps(
+                obj,
+                ensure_ascii=True,
+                escape_forward_slashes=False).encode(ENCODING)
+            # json escapes DEL too
+            if b'\x7f' in encoded:
+                encoded = encoded.replace(b'\x7f', b'\\u007f')
+            return encoded
+        return _stdlibAsCompactJSON(obj, cls)
+
+    _fastFromJSON = ujson.loads
+else:
+    asCompactJSON = _stdlibAsCompactJSON
+    _fastFromJSON = None
+
+
+if _fastFromJSON is not None:
+    def fromJSON(s, *args, **kwargs):
+        if args or kwargs and any(value is not None
+                                  for value in kwargs.values()):
+            return _stdlibFromJSON(s, *args, **kwargs)
+        # both orjson's and ujson's decoding errors are ValueErrors
+        return _fastFromJSON(s)
+else:
+    fromJSON = _stdlibFromJSON
+
+
+def makeCompactJSONEncoder(cls=None):
+    '''Return a function that serializes an object as compact JSON
+    bytes.  A custom JSONEncoder class is instantiated just once,
+    instead of once per call.
+
+    '''
+    if cls is None:
+        return asCompactJSON
+
+    encode = cls(separators=(',', ':')).encode
+    if six.PY3:
+        return lambda obj: encode(obj).encode(ENCODING)
+    return encode
+
+
+def makeJSONDecoder(cls=None):
+    '''Return a function that deserializes JSON bytes.  A custom
+    JSONDecoder class is instantiated just once, instead of once per
+    call.
+
+    '''
+    if cls is None:
+        # skip fromJSON's check for json.loads arguments
+        return _fastFromJSON or fromJSON
+
+    decode = cls().decode
+    if six.PY3:
+        return lambda s: decode(s.decode(ENCODING))
+    return decode
+
+
 if six.PY3:
     # shamelessly lifted from t.p.compat
     def intToBytes(integer):
@@ -9,13 +9,17 @@ python -c 'import sys, txdarn.protocol as P; \
       | dot -Tpng > machine.png
 '''
 
+import itertools
+import re
+import weakref
+
 import txaio
 txaio.use_twisted()
 
 from autobahn.websocket.protocol import WebSocketProtocol
 from autobahn.twisted.websocket import (WrappingWebSocketServerFactory,
                                         WrappingWebSocketServerProtocol)
-from automat import MethodicalMachine
+from automat import MethodicalMachine, NoTransition
 
 from constantly import Values, ValueConstant
 
@@ -26,22 +30,20 @@ from twisted.internet import reactor, protocol, error
 from twisted.python import failure
 from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
 
-from zope.interface import directlyProvides, providedBy
+from zope.interface import directlyProvides, implementedBy, providedBy
 
-from txdarn.compat import asJSON, fromJSON
+from txdarn.compat import (asCompactJSON,
+                           makeCompactJSONEncoder,
+                           makeJSONDecoder)
 
 
 class TxDarnProtocolException(Exception):
     '''Raised when a protocol-level error occurs'''
 
 
-def _trapCancellation(failure):
-    failure.trap(defer.CancelledError)
-
-
 def sockJSJSON(data, cls=None):
     # no spaces
-    return asJSON(data, separators=(',', ':'), cls=cls)
+    return asCompactJSON(data, cls=cls)
 
 
 class INVALID_DATA(Values):
@@ -54,38 +56,65 @@ class DISCONNECT(Values):
     STILL_OPEN = ValueConstant([2010, "Another connection still open"])
 
 
+_OPEN_FRAME = b'o'
+_HEARTBEAT_FRAME = b'h'
+# the HTTP transports write newline-terminated frames
+_OPEN_LINE = _OPEN_FRAME + b'\n'
+_HEARTBEAT_LINE = _HEARTBEAT_FRAME + b'\n'
+
+
+def _closeFrames(jsonEncoder=None):
+    '''Serialize a close frame for every DISCONNECT reason.'''
+    return {reason: b'c' + sockJSJSON(reason.value, cls=jsonEncoder)
+            for reason in DISCONNECT.iterconstants()}
+
+
+_CLOSE_FRAMES = _closeFrames()
+
+
 class HeartbeatClock(object):
     '''Schedules a recurring heartbeat frame, but only if no data has
     been written recently.
 
     '''
-
-    writeHeartbeat = None
-    pendingHeartbeat = None
-    stopped = False
+    __slots__ = ('writeHeartbeat', 'period', 'clock',
+                 'pendingHeartbeat', 'stopped', '_deadline')
 
     def __init__(self, writeHeartbeat=None, period=25.0, clock=reactor):
         self.writeHeartbeat = writeHeartbeat
         self.period = period
         self.clock = clock
+        self.pendingHeartbeat = None
+        self.stopped = False
+        self._deadline = None
 
-    def _createHeartbeatCall(self):
-        self.pendingHeartbeat = self.clock.callLater(self.period,
+    def _createHeartbeatCall(self, delay):
+        self.pendingHeartbeat = self.clock.callLater(delay,
                                                      self._sendHeartbeat)
 
     def _sendHeartbeat(self):
+        self.pendingHeartbeat = None
+        remaining = self._deadline - self.clock.seconds()
+        if remaining > 0:
+            # something was written since this call was scheduled
+            self._createHeartbeatCall(remaining)
+            return
+
         self.writeHeartbeat()
-        self._createHeartbeatCall()
+        if not self.stopped:
+            self.schedule()
 
     def schedule(self):
         """Schedule or reschedule the next heartbeat."""
         if self.stopped:
             raise RuntimeError("Can't schedule stopped heartbeat")
 
+        # schedule() runs on every write, so rather than reset the
+        # pending call, just push back the deadline it checks when
+        # it fires.
+        self._deadline = self.clock.seconds() + self.period
         if self.pendingHeartbeat is None:
-            self._createHeartbeatCall()
-        else:
-            self.pendingHeartbeat.reset(self.period)
+            self._createHeartbeatCall(self.period)
 
     def stop(self):
         """Permanently stop sending heartbeats."""
@@ -96,12 +125,61 @@ class HeartbeatClock(object):
                 self.pendingHeartbeat = None
 
 
+_NOT_YET_CONNECTED, _CONNECTED, _DISCONNECTED = range(3)
+
+
+def _noOutputs(self, *args, **kwargs):
+    pass
+
+
+def _combineOutputs(outputs):
+    '''Return a single function that runs all of a transition's
+    outputs.
+
+    '''
+    if not outputs:
+        return _noOutputs
+    if len(outputs) == 1:
+        return outputs[0]
+
+    def runOutputs(self, *args, **kwargs):
+        for output in outputs:
+            output(self, *args, **kwargs)
+
+    return runOutputs
+
+
+def _flattenTransitions(machine, stateIDs):
+    '''Flatten a MethodicalMachine's transitions into a dictionary
+    mapping each input's name to a tuple indexed by state ID.  Its
+    entries are (function running the outputs, next state ID) pairs,
+    or None where the input has no transition from that state.
+
+    This reads automat's private _automaton and the wrapped methods
+    of its states, inputs and outputs.  setup.py pins automat to the
+    releases this has been checked against.
+
+    '''
+    width = max(stateIDs.values()) + 1
+    rows = {}
+    for (inState, inputSymbol,
+         outState, outputSymbols) in machine._automaton.allTransitions():
+        row = rows.setdefault(inputSymbol.method.__name__, [None] * width)
+        outputs = tuple(output.method for output in outputSymbols)
+        row[stateIDs[inState.method.__name__]] = (
+            _combineOutputs(outputs),
+            stateIDs[outState.method.__name__])
+    return {inputName: tuple(row) for inputName, row in rows.items()}
+
+
 class SockJSProtocolMachine(object):
+    __slots__ = ('heartbeater', 'transport', '_state')
     _machine = MethodicalMachine()
-    transport = None
 
     def __init__(self, heartbeater):
         self.heartbeater = heartbeater
+        self.transport = None
+        self._state = _NOT_YET_CONNECTED
 
     @classmethod
     def withHeartbeater(cls, heartbeater):
@@ -133,32 +211,41 @@ class SockJSProtocolMachine(object):
         self.transport.writeOpen()
         self.heartbeater.schedule()
 
-    @_machine.input()
+    # write, receive and heartbeat run for every frame on a live
+    # connection, so they bypass automat's per-input dispatch and
+    # check the connection state themselves.
     def write(self, data):
-        '''We should write an array-like thing to the transport.'''
+        '''Frame the array-like thing, write it to the transport, and
+        (re)schedule a heartbeat.
 
-    @_machine.output()
-    def _writeToTransport(self, data):
-        '''Frame the array-like thing and write it.'''
+        '''
+        if self._state != _CONNECTED:
+            raise NoTransition(_STATE_NAMES[self._state], 'write')
         self.transport.writeData(data)
         self.heartbeater.schedule()
 
-    @_machine.input()
-    def receive(self, data):
-        '''Data has arrived!'''
+    def writeSequence(self, data):
+        '''Frame a sequence of array-like things as one array, write it
+        to the transport, and (re)schedule a heartbeat.
 
-    @_machine.output()
-    def _received(self, data):
-        """Receive data -- just for completeness' sake"""
+        '''
+        if self._state != _CONNECTED:
+            raise NoTransition(_STATE_NAMES[self._state], 'writeSequence')
+        messages = list(itertools.chain.from_iterable(data))
+        if messages:
+            self.transport.writeData(messages)
+            self.heartbeater.schedule()
+
+    def receive(self, data):
+        '''Data has arrived!  Pass it through.'''
+        if self._state != _CONNECTED:
+            raise NoTransition(_STATE_NAMES[self._state], 'receive')
         return data
 
-    @_machine.input()
     def heartbeat(self):
-        '''Time to send a heartbeat.'''
-
-    @_machine.output()
-    def _writeHeartbeatToTransport(self):
-        '''Write a heartbeat frame'''
+        '''Time to write a heartbeat frame.'''
+        if self._state != _CONNECTED:
+            raise NoTransition(_STATE_NAMES[self._state], 'heartbeat')
         self.transport.writeHeartbeat()
 
     @_machine.input()
@@ -212,17 +299,6 @@ class SockJSProtocolMachine(object):
                          enter=disconnected,
                          outputs=[])
 
-    connected.upon(write,
-                   enter=connected,
-                   outputs=[_writeToTransport])
-    connected.upon(receive,
-                   enter=connected,
-                   outputs=[_received],
-                   collector=lambda x: next(iter(x)))
-
-    connected.upon(heartbeat,
-                   enter=connected,
-                   outputs=[_writeHeartbeatToTransport])
     connected.upon(disconnect,
                    enter=disconnected,
                    outputs=[_writeCloseFrame,
@@ -237,6 +313,44 @@ class SockJSProtocolMachine(object):
                       enter=disconnected,
                       outputs=[])
 
+    # The declarations above describe the machine (and can still draw
+    # it.)  These replace automat's inputs with a lookup in
+    # _TRANSITIONS, a flattened copy of its transitions, so the
+    # upon() declarations still decide what happens.  Every input
+    # declared above needs a method here, or automat's own input
+    # would run and track a state of its own; the tests check this.
+    def _transition(self, inputName):
+        '''Enter the next state for inputName, and return the function
+        that runs its outputs.
+
+        '''
+        transition = _TRANSITIONS[inputName][self._state]
+        if transition is None:
+            raise NoTransition(_STATE_NAMES[self._state], inputName)
+        runOutputs, self._state = transition
+        return runOutputs
+
+    def connect(self, transport):
+        '''Establish a connection on the transport.'''
+        self._transition('connect')(self, transport)
+
+    def disconnect(self, reason=DISCONNECT.GO_AWAY):
+        '''We're closing the connection because of reason.'''
+        self._transition('disconnect')(self, reason)
+
+    def close(self):
+        '''Our connection has been closed'''
+        self._transition('close')(self)
+
+
+_STATE_IDS = {'notYetConnected': _NOT_YET_CONNECTED,
+              'connected': _CONNECTED,
+              'disconnected': _DISCONNECTED}
+_TRANSITIONS = _flattenTransitions(SockJSProtocolMachine._machine,
+                                   _STATE_IDS)
+# NoTransition reports the state's name, as automat's inputs did
+_STATE_NAMES = {stateID: name for name, stateID in _STATE_IDS.items()}
+
 
 class InvalidData(TxDarnProtocolException):
     '''Received invalid JSON.'''
@@ -257,40 +371,56 @@ class SockJSWireProtocolWrapper(ProtocolWrapper):
         ProtocolWrapper.__init__(self, factory, wrappedProtocol)
         self.jsonDecoder = self.factory.jsonDecoder
         self.jsonEncoder = self.factory.jsonEncoder
+        self.encodeJSON = self.factory.encodeJSON
+        self.decodeJSON = self.factory.decodeJSON
+        self.closeFrames = self.factory.closeFrames
 
     def jsonReceived(self, decoded):
-        self.wrappedProtocol.dataReceived(decoded)
+        # an empty batch of messages is a no-op for every transport
+        if decoded:
+            self.wrappedProtocol.dataReceived(decoded)
 
-    def dataReceived(self, data):
+    def _tryParse(self, data):
+        '''Deserialize data.  Return (True, the decoded value), or
+        (False, the INVALID_DATA value describing the problem) if it's
+        missing or isn't JSON.
+
+        '''
         if not data:
-            raise InvalidData(INVALID_DATA.NO_PAYLOAD.value)
-        else:
-            try:
-                decoded = fromJSON(data, cls=self.jsonDecoder)
-            except ValueError:
-                raise InvalidData(INVALID_DATA.BAD_JSON.value)
-            else:
-                self.jsonReceived(decoded)
+            return False, INVALID_DATA.NO_PAYLOAD.value
+        try:
+            return True, self.decodeJSON(data)
+        except ValueError:
+            return False, INVALID_DATA.BAD_JSON.value
+
+    def _parse(self, data):
+        '''Deserialize data, raising InvalidData if it's missing or
+        isn't JSON.
+
+        '''
+        ok, decoded = self._tryParse(data)
+        if not ok:
+            raise InvalidData(decoded)
+        return decoded
+
+    def dataReceived(self, data):
+        self.jsonReceived(self._parse(data))
 
     def writeOpen(self):
         '''Write an open frame.'''
-        self.write(b'o')
+        self.write(_OPEN_FRAME)
 
     def writeHeartbeat(self):
-        self.write(b'h')
+        self.write(_HEARTBEAT_FRAME)
 
     def closeFrame(self, reason):
-        frameValue = [b'c',
-                      sockJSJSON(reason.value, cls=self.jsonEncoder)]
-        return b''.join(frameValue)
+        return self.closeFrames[reason]
 
     def writeClose(self, reason):
         self.write(self.closeFrame(reason))
 
     def writeData(self, data):
-        frameValue = [b'a', sockJSJSON(data, cls=self.jsonEncoder)]
-        data = b''.join(frameValue)
-        self.write(data)
+        self.write(b'a' + self.encodeJSON(data))
 
 
 class SockJSWireProtocolWrappingFactory(WrappingFactory):
@@ -305,11 +435,23 @@ class SockJSWireProtocolWrappingFactory(WrappingFactory):
         WrappingFactory.__init__(self, wrappedFactory)
         self.jsonEncoder = jsonEncoder
         self.jsonDecoder = jsonDecoder
+        # set up (de)serialization once for all our protocols
+        self.encodeJSON = makeCompactJSONEncoder(jsonEncoder)
+        self.decodeJSON = makeJSONDecoder(jsonDecoder)
+        # close frames never change, so serialize them just once
+        if jsonEncoder is None:
+            self.closeFrames = _CLOSE_FRAMES
+        else:
+            self.closeFrames = _closeFrames(jsonEncoder)
 
 
 class SockJSProtocol(ProtocolWrapper):
     '''Wrap a user-supplied protocol for use with SockJS.'''
 
+    # True while the state machine would pass received data straight
+    # through, so dataReceived can skip it.
+    _connected = False
+
     def __init__(self, factory, wrappedProtocol):
         ProtocolWrapper.__init__(self, factory, wrappedProtocol)
         self.sockJSMachine = self.factory.stateMachineFactory()
@@ -319,8 +461,12 @@ class SockJSProtocol(ProtocolWrapper):
         # ProtocolWrapper.makeConnection from calling
         # self.wrappedProtocol.makeConnection
         self.sockJSMachine.connect(self.transport)
+        self._connected = True
 
     def dataReceived(self, data):
+        if self._connected:
+            self.wrappedProtocol.dataReceived(data)
+            return
         data = self.sockJSMachine.receive(data)
         self.wrappedProtocol.dataReceived(data)
 
@@ -328,13 +474,14 @@ class SockJSProtocol(ProtocolWrapper):
         self.sockJSMachine.write(data)
 
     def writeSequence(self, data):
-        for datum in data:
-            self.sockJSMachine.write(datum)
+        self.sockJSMachine.writeSequence(data)
 
     def loseConnection(self):
+        self._connected = False
         self.sockJSMachine.disconnect()
 
     def connectionLost(self, reason=protocol.connectionDone):
+        self._connected = False
         self.sockJSMachine.close()
         self.sockJSMachine = None
         self.wrappedProtocol.connectionLost(reason)
@@ -363,13 +510,36 @@ class SessionTimeout(Exception):
     """A session has timed out before all its data has been written."""
 
 
+# the ways a session normally ends
+_SESSION_CLOSED_TRAP = (error.ConnectionDone,
+                        error.ConnectionLost,
+                        SessionTimeout)
+
+
+# RequestSessionMachine's states are combinations of these flags.
+_HAS_REQUEST = 1 << 0
+_BUFFER_PENDING = 1 << 1
+_LOSING_CONNECTION = 1 << 2
+_UNCONNECTED = 1 << 3
+
+_NEVER_CONNECTED = _UNCONNECTED
+_HAVE_TRANSPORT = _HAS_REQUEST
+_NO_TRANSPORT_EMPTY_BUFFER = 0
+_NO_TRANSPORT_PENDING = _BUFFER_PENDING
+_LOSE_CONNECTION_EMPTY_BUFFER = _LOSING_CONNECTION
+_LOSE_CONNECTION_PENDING = _LOSING_CONNECTION | _BUFFER_PENDING
+_SESSION_DISCONNECTED = _UNCONNECTED | _LOSING_CONNECTION
+
+
 class RequestSessionMachine(object):
+    __slots__ = ('buffer', 'requestSession', '_state', '_closeReason')
     _machine = MethodicalMachine()
-    _closeReason = None
 
     def __init__(self, requestSession):
         self.buffer = []
         self.requestSession = requestSession
+        self._state = _NEVER_CONNECTED
+        self._closeReason = None
 
     @_machine.state(initial=True)
     def neverConnected(self):
@@ -471,20 +641,26 @@ class RequestSessionMachine(object):
 
     @_machine.output()
     def _bufferWrite(self, data):
-        '''Without a request, we have to buffer our writes.'''
-        self.buffer.extend(data)
+        '''Without a request, we have to buffer our writes.  Serialize
+        them now, so that flushing the buffer is a single join.
+
+        '''
+        encoded = self.requestSession.encodeData(data)
+        if encoded:
+            self.buffer.append(encoded)
 
     @_machine.output()
     def _flushBuffer(self, request):
         '''Flush any pending data from the buffer to the request'''
         assert request is self.requestSession.request
-        self.requestSession.writeData(self.buffer)
-        self.buffer = []
+        self.requestSession.writeRawFrame(
+            b'a[' + b','.join(self.buffer) + b']')
+        del self.buffer[:]
 
     @_machine.output()
     def _dumpBuffer(self):
         '''Forget the contents of the buffer.'''
-        self.buffer = []
+        del self.buffer[:]
 
     @_machine.output()
     def _directWrite(self, data):
@@ -648,48 +824,160 @@ class RequestSessionMachine(object):
                                enter=loseConnectionPending,
                                outputs=[])
 
+    # As with SockJSProtocolMachine, the declarations above describe
+    # the machine, and these replace automat's inputs with a lookup in
+    # _REQUEST_SESSION_TRANSITIONS.  Every input declared above needs
+    # a method here.
+    def _transition(self, inputName):
+        '''Enter the next state for inputName, and return the function
+        that runs its outputs.
+
+        '''
+        transition = _REQUEST_SESSION_TRANSITIONS[inputName][self._state]
+        if transition is None:
+            raise NoTransition(_REQUEST_SESSION_STATE_NAMES[self._state],
+                               inputName)
+        runOutputs, self._state = transition
+        return runOutputs
+
+    def attach(self, request):
+        '''Attach to the request, performing setup if necessary.'''
+        self._transition('attach')(self, request)
+
+    def detach(self):
+        '''Detach the current request'''
+        self._transition('detach')(self)
+
+    def write(self, data):
+        '''The protocol wants to write to the transport.'''
+        self._transition('write')(self, data)
+
+    def receive(self, data):
+        '''The underlying transport wants to us to receive some data.'''
+        self._transition('receive')(self, data)
+
+    def writeClose(self, reason):
+        '''The protocol wants to close the session for reason'''
+        self._transition('writeClose')(self, reason)
+
+    def heartbeat(self):
+        '''The protocol wants to send a heartbeat.'''
+        if not self._state & ~_BUFFER_PENDING:
+            # a detached session's heartbeats go nowhere, whether or
+            # not it has pending data, and it may stay detached for a
+            # long time.
+            return
+        self._transition('heartbeat')(self)
+
+    def loseConnection(self):
+        '''Lose the request, if applicable.'''
+        self._transition('loseConnection')(self)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        '''The connection has been lost; clean up any request and clean up
+        the protocol.
+
+        '''
+        self._transition('connectionLost')(self, reason)
+
+
+_REQUEST_SESSION_STATE_IDS = {
+    'neverConnected': _NEVER_CONNECTED,
+    'connectedHaveTransport': _HAVE_TRANSPORT,
+    'connectedNoTransportEmptyBuffer': _NO_TRANSPORT_EMPTY_BUFFER,
+    'connectedNoTransportPending': _NO_TRANSPORT_PENDING,
+    'loseConnectionEmptyBuffer': _LOSE_CONNECTION_EMPTY_BUFFER,
+    'loseConnectionPending': _LOSE_CONNECTION_PENDING,
+    'disconnected': _SESSION_DISCONNECTED}
+_REQUEST_SESSION_TRANSITIONS = _flattenTransitions(
+    RequestSessionMachine._machine, _REQUEST_SESSION_STATE_IDS)
+_REQUEST_SESSION_STATE_NAMES = {
+    stateID: name for name, stateID in _REQUEST_SESSION_STATE_IDS.items()}
+
 
 class TimeoutClock(object):
     '''
     Expires sessions.
     '''
+    __slots__ = ('length', 'clock', 'terminationDeferred',
+                 'expired', 'timeoutCall', '_deadline')
     EXPIRED = 'EXPIRED'
 
-    expired = False
-    timeoutCall = None
-
     def __init__(self, terminationDeferred, length=5.0, clock=reactor):
         self.length = length
         self.clock = clock
         self.terminationDeferred = terminationDeferred
+        self.expired = False
+        self.timeoutCall = None
+        # when the session expires, or None if the timeout isn't
+        # running
+        self._deadline = None
 
     def _expire(self):
         self.expired = True
         self.timeoutCall = None
         self.terminationDeferred.callback(self.EXPIRED)
 
+    def _check(self):
+        self.timeoutCall = None
+        if self._deadline is None:
+            # reset since this call was scheduled
+            return
+
+        remaining = self._deadline - self.clock.seconds()
+        if remaining > 0:
+            self.timeoutCall = self.clock.callLater(remaining, self._check)
+        else:
+            self._expire()
+
     def reset(self):
         if self.expired:
             raise RuntimeError("Cannot restart expired timeout.")
 
-        if self.timeoutCall is not None:
-            self.timeoutCall.cancel()
-            self.timeoutCall = None
+        # sessions reset and start their timeouts for every request,
+        # so leave any pending call in place; it will check the
+        # deadline when it fires.
+        self._deadline = None
 
     def start(self):
         if self.expired:
             raise RuntimeError("Cannot start expired timeout.")
 
-        if not self.expired and self.timeoutCall is None:
+        if self._deadline is None:
+            self._deadline = self.clock.seconds() + self.length
+        if self.timeoutCall is None:
             self.timeoutCall = self.clock.callLater(self.length,
-                                                    self._expire)
+                                                    self._check)
 
     def stop(self):
+        self._deadline = None
         if not self.expired and self.timeoutCall is not None:
             self.timeoutCall.cancel()
             self.timeoutCall = None
 
 
+_implementedByTransportType = {}
+
+
+def _transportInterfaces(transport):
+    '''Return the interfaces transport provides.  Unless it directly
+    provides some (as TLS transports do), these are the interfaces
+    its class implements, which are only looked up once per class.
+
+    '''
+    if '__provides__' in getattr(transport, '__dict__', ()):
+        return providedBy(transport)
+    # not type(transport), which is InstanceType for every classic
+    # class instance on Python 2
+    transportType = transport.__class__
+    try:
+        return _implementedByTransportType[transportType]
+    except KeyError:
+        interfaces = implementedBy(transportType)
+        _implementedByTransportType[transportType] = interfaces
+        return interfaces
+
+
 class RequestSessionProtocolWrapper(SockJSWireProtocolWrapper):
     """A protocol wrapper that uses an http.Request object as its
     transport.
@@ -714,6 +1002,16 @@ class RequestSessionProtocolWrapper(SockJSWireProtocolWrapper):
         self.timeoutClock = self.factory.timeoutClockFactory(
             self.terminationDeferred)
 
+        self.closeLines = self.factory.closeLines
+
+        # bound once, rather than once per request
+        self._requestFailedErrback = self._requestFailed
+
+        # bind the wire protocol's dataReceived once, for the session
+        # state machine's hot transitions
+        self._wireDataReceived = (
+            SockJSWireProtocolWrapper.dataReceived.__get__(self))
+
     def makeConnection(self, transport):
         name = self.__class__.__name__
         raise RuntimeError(
@@ -730,11 +1028,30 @@ class RequestSessionProtocolWrapper(SockJSWireProtocolWrapper):
     def detachFromRequest(self):
         self.sessionMachine.detach()
 
+    def writeLine(self, line):
+        '''Write an already newline-terminated frame.'''
+        self.request.write(line)
+
     def write(self, data):
-        self.request.write(data + b'\n')
+        self.writeLine(data + b'\n')
+
+    def writeOpen(self):
+        self.writeLine(_OPEN_LINE)
+
+    def encodeData(self, data):
+        '''Serialize the elements of the array-like data, without the
+        enclosing brackets, so they can later be joined into a single
+        data frame.
+
+        '''
+        return self.encodeJSON(data)[1:-1]
+
+    def writeRawFrame(self, frame):
+        '''Write an already serialized frame.'''
+        self.write(frame)
 
     def closeOtherRequest(self, request, reason):
-        request.write(self.closeFrame(reason) + b'\n')
+        request.write(self.closeLines[reason])
         request.finish()
 
     def dataReceived(self, data):
@@ -776,14 +1093,22 @@ class RequestSessionProtocolWrapper(SockJSWireProtocolWrapper):
         self.disconnecting = 1
         self.connectionLost()
 
+    def _requestFailed(self, reason):
+        '''The current request's notifyFinish Deferred failed.  We
+        cancel it ourselves in finishCurrentRequest; anything else
+        means the connection was lost.
+
+        '''
+        if reason.check(defer.CancelledError) is None:
+            self.connectionLost(reason)
+
     def beginRequest(self):
         self.finishedNotifier = self.request.notifyFinish()
-        self.finishedNotifier.addErrback(_trapCancellation)
-        self.finishedNotifier.addErrback(self.connectionLost)
+        self.finishedNotifier.addErrback(self._requestFailedErrback)
         self.timeoutClock.reset()
 
     def establishConnection(self, request):
-        directlyProvides(self, providedBy(request.transport))
+        directlyProvides(self, _transportInterfaces(request.transport))
         protocol.Protocol.makeConnection(self, request.transport)
         self.factory.registerProtocol(self)
 
@@ -791,13 +1116,19 @@ class RequestSessionProtocolWrapper(SockJSWireProtocolWrapper):
         self.wrappedProtocol.makeConnection(self)
 
     def completeDataReceived(self, data):
-        SockJSWireProtocolWrapper.dataReceived(self, data)
+        self._wireDataReceived(data)
 
     def completeWrite(self, data):
-        SockJSWireProtocolWrapper.writeData(self, data)
+        '''Write the array-like data as a data frame.'''
+        # build the newline-terminated data frame with a single join,
+        # rather than concatenating the newline onto an already
+        # concatenated frame.  It's written with a single call because
+        # each write becomes its own chunk of a chunked response.
+        frame = b''.join([b'a', self.encodeJSON(data), b'\n'])
+        self.writeLine(frame)
 
     def completeHeartbeat(self):
-        SockJSWireProtocolWrapper.writeHeartbeat(self)
+        self.writeLine(_HEARTBEAT_LINE)
 
     def completeConnectionLost(self, reason):
         SockJSWireProtocolWrapper.connectionLost(self, reason)
@@ -818,12 +1149,16 @@ class RequestSessionWrappingFactory(SockJSWireProtocolWrappingFactory):
     protocol = RequestSessionProtocolWrapper
 
     def __init__(self, wrappedFactory, timeout=5.0,
-                 jsonEncoder=None, jsonDecoder=None):
+                 jsonEncoder=None, jsonDecoder=None, clock=reactor):
         SockJSWireProtocolWrappingFactory.__init__(self,
                                                    wrappedFactory,
                                                    jsonEncoder=jsonEncoder,
                                                    jsonDecoder=jsonDecoder)
         self.timeout = timeout
+        self.clock = clock
+        # HTTP transports write their close frames as lines
+        self.closeLines = {reason: frame + b'\n'
+                           for reason, frame in self.closeFrames.items()}
 
     def sessionMachineFactory(self, protocol):
         return RequestSessionMachine(protocol)
@@ -832,22 +1167,26 @@ class RequestSessionWrappingFactory(SockJSWireProtocolWrappingFactory):
         return TimeoutClock(terminationDeferred, self.timeout)
 
 
+# a server ID, session ID or transport: non-empty and without dots
+_matchPathSegment = re.compile(b'[^.]+\\Z').match
+
+
 class SessionHouse(object):
 
     def __init__(self):
         self.sessions = {}
 
     def validateAndExtractSessionID(self, request):
-        try:
-            serverID, sessionID, _ = request.postpath
-        except ValueError:
+        postpath = request.postpath
+        if len(postpath) != 3:
             return None
 
-        if any(not identifier or b'.' in identifier
-               for identifier in request.postpath):
-            return None
-
-        return sessionID
+        serverID, sessionID, transport = postpath
+        if (_matchPathSegment(serverID) and
+                _matchPathSegment(sessionID) and
+                _matchPathSegment(transport)):
+            return sessionID
+        return None
 
     def makeSession(self, sessionID, factory, request):
         protocol = factory.buildProtocol(request.transport.getPeer())
@@ -858,13 +1197,11 @@ class SessionHouse(object):
         return protocol
 
     def _sessionClosed(self, maybeFailure, sessionID):
-        del self.sessions[sessionID]
+        self.sessions.pop(sessionID, None)
         if isinstance(maybeFailure, failure.Failure):
-            failure.trap(error.ConnectionDone,
-                         error.ConnectionLost,
-                         SessionTimeout)
-        else:
-            return maybeFailure
+            maybeFailure.trap(*_SESSION_CLOSED_TRAP)
+            return None
+        return maybeFailure
 
     def attachToSession(self, factory, request):
         sessionID = self.validateAndExtractSessionID(request)
@@ -894,6 +1231,37 @@ class SessionHouse(object):
 
 
 class XHRSession(RequestSessionProtocolWrapper):
+    _pendingDetach = None
+
+    def detachFromRequest(self):
+        '''Detach the current request on the next reactor iteration, so
+        that everything written to it during this one goes out in the
+        same response.
+
+        '''
+        request = self.request
+        if request is None:
+            # detached already; the machine buffers anything written
+            return
+        if self._pendingDetach is not None:
+            if self._pendingDetach.args[0] is request:
+                return
+            # scheduled for a request that's since been replaced
+            self._pendingDetach.cancel()
+        self._pendingDetach = self.factory.clock.callLater(
+            0, self._detachRequest, request)
+
+    def _detachRequest(self, request):
+        self._pendingDetach = None
+        # the request may have been finished, or even replaced, since
+        if self.sessionMachine is not None and self.request is request:
+            RequestSessionProtocolWrapper.detachFromRequest(self)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self._pendingDetach is not None:
+            self._pendingDetach.cancel()
+            self._pendingDetach = None
+        RequestSessionProtocolWrapper.connectionLost(self, reason)
 
     def writeOpen(self):
         RequestSessionProtocolWrapper.writeOpen(self)
@@ -903,26 +1271,86 @@ class XHRSession(RequestSessionProtocolWrapper):
         RequestSessionProtocolWrapper.writeData(self, data)
         self.detachFromRequest()
 
+    def writeRawFrame(self, frame):
+        RequestSessionProtocolWrapper.writeRawFrame(self, frame)
+        self.detachFromRequest()
+
 
 class XHRSessionFactory(RequestSessionWrappingFactory):
     protocol = XHRSession
 
 
+# shared by every streaming session; bytes are immutable, so nothing
+# ever needs its own copy
+_XHR_STREAMING_PRELUDE = b'h' * 2048
+
+
 class XHRStreamingSession(RequestSessionProtocolWrapper):
-    prelude = b'h' * 2048
+    prelude = _XHR_STREAMING_PRELUDE
     bytesWritten = 0
+    _pendingFlush = None
+
+    def __init__(self, *args, **kwargs):
+        RequestSessionProtocolWrapper.__init__(self, *args, **kwargs)
+        # newline-terminated frames written during this reactor
+        # iteration, which go out on the request as a single chunk
+        self._pendingFrames = []
 
     def writeOpen(self):
-        self.write(self.prelude)
-        RequestSessionProtocolWrapper.writeOpen(self)
+        # one write, and so one chunk, for both
+        self.request.write(b''.join([self.prelude, b'\n', _OPEN_LINE]))
 
-    def completeWrite(self, data):
-        RequestSessionProtocolWrapper.completeWrite(self, data)
-        self.bytesWritten += sum(map(len, data))
+    def _writeSoon(self, framed):
+        self._pendingFrames.append(framed)
+        if self._pendingFlush is None:
+            self._pendingFlush = self.factory.clock.callLater(
+                0, self._flushPendingFrames)
+
+    def _writePendingFrames(self):
+        '''Write all pending frames to the request at once, and return
+        the number of bytes written.
+
+        '''
+        if self._pendingFlush is not None:
+            if self._pendingFlush.active():
+                self._pendingFlush.cancel()
+            self._pendingFlush = None
+        if not self._pendingFrames:
+            return 0
+        written = b''.join(self._pendingFrames)
+        del self._pendingFrames[:]
+        self.request.write(written)
+        return len(written)
+
+    def _flushPendingFrames(self):
+        self._pendingFlush = None
+        self._countBytes(self._writePendingFrames())
+
+    def _countBytes(self, written):
+        self.bytesWritten += written
         if self.bytesWritten >= self.factory.maximumBytes:
             self.bytesWritten = 0
             self.detachFromRequest()
 
+    def writeLine(self, line):
+        # heartbeats and serialized frames must stay in order with
+        # the data frames, so they wait for the flush too
+        self._writeSoon(line)
+
+    def finishCurrentRequest(self):
+        # the request is going away, so there's no point in checking
+        # maximumBytes
+        self.bytesWritten += self._writePendingFrames()
+        RequestSessionProtocolWrapper.finishCurrentRequest(self)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        # the request is gone, and pending frames with it
+        if self._pendingFlush is not None:
+            self._pendingFlush.cancel()
+            self._pendingFlush = None
+        del self._pendingFrames[:]
+        RequestSessionProtocolWrapper.connectionLost(self, reason)
+
 
 class XHRStreamingSessionFactory(RequestSessionWrappingFactory):
     protocol = XHRStreamingSession
@@ -934,16 +1362,15 @@ class XHRStreamingSessionFactory(RequestSessionWrappingFactory):
 
 class WebSocketProtocolWrapper(SockJSWireProtocolWrapper):
 
-    def jsonReceived(self, decoded):
-        if decoded:
-            SockJSWireProtocolWrapper.jsonReceived(self, decoded)
-
     def dataReceived(self, data):
         if not data:
             return
-        try:
-            SockJSWireProtocolWrapper.dataReceived(self, data)
-        except InvalidData:
+        # a misbehaving client's bad data just closes the connection,
+        # so there's no need to raise InvalidData for it
+        ok, decoded = self._tryParse(data)
+        if ok:
+            self.jsonReceived(decoded)
+        else:
             self.loseConnection()
 
 
@@ -951,6 +1378,29 @@ class WebSocketWrappingFactory(SockJSWireProtocolWrappingFactory):
     protocol = WebSocketProtocolWrapper
 
 
+# keyed by the id of the wrapped factory, which each cached
+# WebSocketWrappingFactory keeps alive, so the id can't be reused
+# while its entry exists
+_webSocketWrappingFactories = weakref.WeakValueDictionary()
+
+
+def _sharedWebSocketWrappingFactory(wrappedFactory):
+    '''Return the WebSocketWrappingFactory for wrappedFactory, creating
+    it only if no other WebSocketSessionFactory is using one.
+
+    '''
+    key = id(wrappedFactory)
+    wrappingFactory = _webSocketWrappingFactories.get(key)
+    if wrappingFactory is None:
+        wrappingFactory = WebSocketWrappingFactory(wrappedFactory)
+        _webSocketWrappingFactories[key] = wrappingFactory
+    return wrappingFactory
+
+
+# autobahn hands us subprotocols as text, but accept bytes too
+_BINARY_PROTOCOL_TOKENS = frozenset([b'binary', u'binary'])
+
+
 class _WebSocketServerProtocol(WrappingWebSocketServerProtocol):
     '''Autobahn's WrappingWebSocketServerProtocol requires that text
     frames be base64 encoded.  This breaks SockJS (and presumably many
@@ -960,32 +1410,57 @@ class _WebSocketServerProtocol(WrappingWebSocketServerProtocol):
 
     '''
 
+    def __init__(self, addr, factory):
+        super(_WebSocketServerProtocol, self).__init__()
+        self.factory = factory
+        self._proto = factory._factory.buildProtocol(addr)
+        self._proto.transport = self
+
     def onConnect(self, request):
         # base64 is not required for text frames
-        self._binaryMode = any(b'binary' in p for p in request.protocols)
+        self._binaryMode = not _BINARY_PROTOCOL_TOKENS.isdisjoint(
+            request.protocols)
+        # the mode can't change now, so pick our write and onMessage
+        # methods once.  Nothing writes or receives before this: the
+        # wrapped protocol is only connected in onOpen.
+        if self._binaryMode:
+            self.write = self._writeBinary
+            self.onMessage = self._onMessageBinary
+        else:
+            self.write = self._writeText
+            self.onMessage = self._onMessageText
 
     def onOpen(self):
         # override default behavior of calling connectionMade directly
         self._proto.makeConnection(self)
 
-    def write(self, data):
-        # base64 is not required for text frames
-        assert type(data) == bytes
-        if self._binaryMode:
-            self.sendMessage(data, isBinary=True)
+    # data is always bytes: the wire protocol only writes frames it
+    # serialized itself.  isBinary is passed positionally to spare
+    # the call a keyword argument.
+    def _writeBinary(self, data):
+        self.sendMessage(data, True)
+
+    def _writeText(self, data):
+        self.sendMessage(data, False)
+
+    def _onMessageBinary(self, payload, isBinary):
+        if isBinary:
+            self._proto.dataReceived(payload)
         else:
-            self.sendMessage(data, isBinary=False)
+            self._failPayloadType()
 
-    def onMessage(self, payload, isBinary):
-        # base64 is not required for text frames
-        if isBinary != self._binaryMode:
-            self.failConnection(
-                WebSocketProtocol.CLOSE_STATUS_CODE_UNSUPPORTED_DATA,
-                "message payload type does not match"
-                " the negotiated subprotocol")
+    def _onMessageText(self, payload, isBinary):
+        if isBinary:
+            self._failPayloadType()
         else:
             self._proto.dataReceived(payload)
 
+    def _failPayloadType(self):
+        self.failConnection(
+            WebSocketProtocol.CLOSE_STATUS_CODE_UNSUPPORTED_DATA,
+            "message payload type does not match"
+            " the negotiated subprotocol")
+
 
 class WebSocketSessionFactory(WrappingWebSocketServerFactory):
 
@@ -995,7 +1470,7 @@ class WebSocketSessionFactory(WrappingWebSocketServerFactory):
                  autoFragmentSize=0,
                  subprotocol=None):
 
-        sockJSWrappedFactory = WebSocketWrappingFactory(
+        sockJSWrappedFactory = _sharedWebSocketWrappingFactory(
             wrappedFactory)
         WrappingWebSocketServerFactory.__init__(
             self,
@@ -1007,8 +1482,4 @@ class WebSocketSessionFactory(WrappingWebSocketServerFactory):
             subprotocol=subprotocol)
 
     def buildProtocol(self, addr):
-        proto = _WebSocketServerProtocol()
-        proto.factory = self
-        proto._proto = self._factory.buildProtocol(addr)
-        proto._proto.transport = proto
-        return proto
+        return _WebSocketServerProtocol(addr, self)
@@ -1,3 +1,5 @@
+import json
+
 import six
 
 from twisted.trial import unittest
@@ -13,6 +15,13 @@ def skipIfVersion(test):
     return _decorator
 
 
+class ComplexEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, complex):
+            return [obj.real, obj.imag]
+        return json.JSONEncoder.default(self, obj)
+
+
 class CompatTestCase(unittest.SynchronousTestCase):
 
     def test_asJSON(self):
@@ -24,10 +33,86 @@ class CompatTestCase(unittest.SynchronousTestCase):
                                   sort_keys=True),
                          b'{"a": [1], "b": [0]}')
 
+    def test_asCompactJSON(self):
+        self.assertEqual(C.asCompactJSON({'a': [1, "b"]}),
+                         b'{"a":[1,"b"]}')
+
+    def test_asCompactJSON_escapesNonASCII(self):
+        self.assertEqual(C.asCompactJSON([u'\xe9']),
+                         b'["\\u00e9"]')
+        self.assertEqual(C.asCompactJSON({u'\U0001f600': u'\x7f'}),
+                         b'{"\\ud83d\\ude00":"\\u007f"}')
+
+    def test_asCompactJSON_nonStringKeys(self):
+        self.assertEqual(C.asCompactJSON({1: 2}),
+                         b'{"1":2}')
+
+    def test_asCompactJSON_withEncoder(self):
+        self.assertEqual(C.asCompactJSON([2 + 1j], cls=ComplexEncoder),
+                         b'[[2.0,1.0]]')
+
+    def test_makeCompactJSONEncoder(self):
+        self.assertIs(C.makeCompactJSONEncoder(), C.asCompactJSON)
+
+        encode = C.makeCompactJSONEncoder(ComplexEncoder)
+        self.assertEqual(encode([2 + 1j, u'\xe9']),
+                         b'[[2.0,1.0],"\\u00e9"]')
+
+    def test_makeJSONDecoder(self):
+        self.assertIs(C.makeJSONDecoder(), C._fastFromJSON or C.fromJSON)
+
+        class ListDecoder(json.JSONDecoder):
+            def decode(self, s):
+                return list(json.JSONDecoder.decode(self, s))
+
+        decode = C.makeJSONDecoder(ListDecoder)
+        self.assertEqual(decode(b'{"a": 1}'), ["a"])
+
+        with self.assertRaises(ValueError):
+            decode(b'!!!')
+
     def test_fromJSON(self):
         self.assertEqual(C.fromJSON(b'{"a": [1]}'),
                          {"a": [1]})
 
+    def test_asCompactJSON_nonFiniteFloats(self):
+        self.assertEqual(C.asCompactJSON([float('nan'), float('inf'),
+                                          -float('inf'), None]),
+                         b'[NaN,Infinity,-Infinity,null]')
+        self.assertEqual(C.asCompactJSON({'a': [(1.5, float('nan'))]}),
+                         b'{"a":[[1.5,NaN]]}')
+
+    def test_fromJSON_acceptsWhatJSONAccepts(self):
+        self.assertEqual(C.fromJSON(b'["\\ud800"]'), [u'\ud800'])
+        self.assertEqual(C.fromJSON(b'[1e400, -Infinity]'),
+                         [float('inf'), -float('inf')])
+        [nan] = C.fromJSON(b'[NaN]')
+        self.assertNotEqual(nan, nan)
+
+    def test_makeJSONDecoder_acceptsWhatJSONAccepts(self):
+        decode = C.makeJSONDecoder()
+        self.assertEqual(decode(b'["\\ud800", 1e400]'),
+                         [u'\ud800', float('inf')])
+
+        with self.assertRaises(ValueError):
+            decode(b'!!!')
+
+    def test_fromJSON_invalid(self):
+        with self.assertRaises(ValueError):
+            C.fromJSON(b'!!!')
+
+    def test_fromJSON_invalidParsedOnce(self):
+        reparsed = []
+
+        def recordStdlibFromJSON(s, *args, **kwargs):
+            reparsed.append(s)
+            raise ValueError(s)
+
+        self.patch(C, '_stdlibFromJSON', recordStdlibFromJSON)
+        with self.assertRaises(ValueError):
+            C.makeJSONDecoder()(b'["unterminated')
+        self.assertEqual(reparsed, [])
+
     def test_fromJSON_withMoreArguments(self):
         called = []
 
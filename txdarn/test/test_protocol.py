@@ -1,3 +1,4 @@
+import inspect
 import io
 import json
 
@@ -6,7 +7,7 @@ import autobahn.websocket.types as A
 
 from twisted.trial import unittest
 from twisted.internet import error
-from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.defer import Deferred
 from twisted.internet.protocol import Protocol, Factory, connectionDone
 from twisted.test.proto_helpers import StringTransport
 from twisted.internet.task import Clock
@@ -14,11 +15,16 @@ from twisted.internet.address import IPv4Address
 # TODO: don't use twisted's private test APIs
 from twisted.web.test.requesthelper import DummyRequest
 
-from zope.interface import Interface, implementer, implementedBy
+from zope.interface import (Interface, implementer, implementedBy,
+                            directlyProvides)
 
 from .. import protocol as P
 
 
+# addresses are immutable, so every test can share this one
+ADDRESS = IPv4Address('TCP', '127.0.0.1', 80)
+
+
 class sockJSJSONTestCase(unittest.SynchronousTestCase):
 
     def test_sockJSJSON(self):
@@ -89,6 +95,24 @@ class HeartbeatClockTestCase(unittest.TestCase):
         self.assertEqual(self.clock.getDelayedCalls(),
                          [rescheduledPendingBeat])
 
+    def test_schedule_postpones(self):
+        '''A schedule() call postpones the next heartbeat until a full
+        period has passed without another schedule() call, without
+        scheduling a second call.
+
+        '''
+        self.heartbeater.schedule()
+        self.clock.advance(self.period - 1)
+        self.heartbeater.schedule()
+
+        self.clock.advance(1)
+        self.assertFalse(self.heartbeats)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(self.period - 1)
+        self.assertEqual(self.heartbeats, 1)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
     def test_schedule_stop(self):
         '''A stop() call removes any pending heartbeats.'''
         self.heartbeater.schedule()
@@ -149,6 +173,25 @@ class EchoProtocolFactory(Factory):
         self.connectionLost = connectionLost
 
 
+class ComplexEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, complex):
+            return [obj.real, obj.imag]
+        # Let the base class default method raise the TypeError
+        return json.JSONEncoder.default(self, obj)
+
+
+class SetDecoder(json.JSONDecoder):
+    def __init__(self, *args, **kwargs):
+        kwargs['object_hook'] = self.set_object_hook
+        super(SetDecoder, self).__init__(*args, **kwargs)
+
+    def set_object_hook(self, obj):
+        if isinstance(obj, dict) and obj.get('!set'):
+            return set(obj['!set'])
+        return obj
+
+
 class SockJSWireProtocolWrapperTestCase(unittest.TestCase):
     '''Sanity tests for SockJS transport base class.'''
 
@@ -161,7 +204,7 @@ class SockJSWireProtocolWrapperTestCase(unittest.TestCase):
                                                        self.connectionsLost)
         self.factory = self.makeFactory()
 
-        self.address = IPv4Address('TCP', '127.0.0.1', 80)
+        self.address = ADDRESS
 
         self.protocol = self.factory.buildProtocol(self.address)
         self.protocol.makeConnection(self.transport)
@@ -209,6 +252,18 @@ class SockJSWireProtocolWrapperTestCase(unittest.TestCase):
         self.assertEqual(frame, b'c[3000,"Go away!"]')
         self.assertFalse(self.transport.value())
 
+    def test_closeFramesPrecomputed(self):
+        '''Close frames are serialized once, ahead of time, for every
+        disconnection reason.
+
+        '''
+        self.assertEqual(
+            self.protocol.closeFrame(P.DISCONNECT.STILL_OPEN),
+            b'c[2010,"Another connection still open"]')
+        self.assertIs(self.protocol.closeFrame(P.DISCONNECT.GO_AWAY),
+                      self.factory.buildProtocol(self.address).closeFrame(
+                          P.DISCONNECT.GO_AWAY))
+
     def test_emptyDataReceived(self):
         '''The wrapped protocol does not receive empty strings and the sender
         receives an error message.
@@ -221,6 +276,14 @@ class SockJSWireProtocolWrapperTestCase(unittest.TestCase):
                          P.INVALID_DATA.NO_PAYLOAD.value)
         self.assertFalse(self.receivedData)
 
+    def test_emptyMessagesReceived(self):
+        '''The wrapped protocol does not receive an empty list of
+        messages.
+
+        '''
+        self.protocol.dataReceived(b'[]')
+        self.assertFalse(self.receivedData)
+
     def test_badJSONReceived(self):
         '''The wrapped protocol does not receive malformed JSON and the sender
         receives an error message.
@@ -233,18 +296,22 @@ class SockJSWireProtocolWrapperTestCase(unittest.TestCase):
                          P.INVALID_DATA.BAD_JSON.value)
         self.assertFalse(self.receivedData)
 
+    def test_tryParse(self):
+        '''_tryParse reports invalid data by returning the reason rather
+        than raising InvalidData.
+
+        '''
+        self.assertEqual(self.protocol._tryParse(b'[1]'), (True, [1]))
+        self.assertEqual(self.protocol._tryParse(b''),
+                         (False, P.INVALID_DATA.NO_PAYLOAD.value))
+        self.assertEqual(self.protocol._tryParse(b'!!!'),
+                         (False, P.INVALID_DATA.BAD_JSON.value))
+
     def test_jsonEncoder(self):
         '''SockJSWireProtocolWrapper can use a json.JSONEncoder subclass for
         writes.
 
         '''
-        class ComplexEncoder(json.JSONEncoder):
-            def default(self, obj):
-                if isinstance(obj, complex):
-                    return [obj.real, obj.imag]
-                # Let the base class default method raise the TypeError
-                return json.JSONEncoder.default(self, obj)
-
         factory = P.SockJSWireProtocolWrappingFactory(
             self.wrappedFactory,
             jsonEncoder=ComplexEncoder)
@@ -261,16 +328,6 @@ class SockJSWireProtocolWrapperTestCase(unittest.TestCase):
         receives.
 
         '''
-        class SetDecoder(json.JSONDecoder):
-            def __init__(self, *args, **kwargs):
-                kwargs['object_hook'] = self.set_object_hook
-                super(SetDecoder, self).__init__(*args, **kwargs)
-
-            def set_object_hook(self, obj):
-                if isinstance(obj, dict) and obj.get('!set'):
-                    return set(obj['!set'])
-                return obj
-
         factory = P.SockJSWireProtocolWrappingFactory(
             self.wrappedFactory,
             jsonDecoder=SetDecoder)
@@ -283,6 +340,8 @@ class SockJSWireProtocolWrapperTestCase(unittest.TestCase):
 
 
 class RecordsWireProtocolActions(object):
+    __slots__ = ('lostConnection', 'wroteOpen', 'wroteHeartbeat',
+                 'wroteData', 'wroteClose')
 
     def __init__(self):
         self.lostConnection = 0
@@ -300,6 +359,7 @@ class RecordsWireProtocolActions(object):
 
 
 class FakeSockJSWireProtocol(object):
+    __slots__ = ('_recorder',)
 
     def __init__(self, recorder):
         self._recorder = recorder
@@ -321,6 +381,7 @@ class FakeSockJSWireProtocol(object):
 
 
 class RecordsHeartbeat(object):
+    __slots__ = ('scheduleCalls', 'stopCalls')
 
     def __init__(self):
         self.scheduleCalls = 0
@@ -334,6 +395,7 @@ class RecordsHeartbeat(object):
 
 
 class FakeHeartbeatClock(object):
+    __slots__ = ('writeHeartbeat', '_recorder')
 
     def __init__(self, recorder):
         self.writeHeartbeat = None
@@ -346,6 +408,46 @@ class FakeHeartbeatClock(object):
         self._recorder.stopCalled()
 
 
+def assertDispatchMatchesMachine(testCase, machineClass, table, stateIDs,
+                                 inputArguments):
+    '''Assert that table holds exactly the transitions declared to
+    machineClass's automat machine, and that each of the machine's
+    inputs is a hand-written method that dispatches through the
+    table.  inputArguments maps input names to the positional
+    arguments to call them with.
+
+    '''
+    transitions = list(machineClass._machine._automaton.allTransitions())
+    inputNames = set()
+    for inState, inputSymbol, outState, outputSymbols in transitions:
+        inputName = inputSymbol.method.__name__
+        inputNames.add(inputName)
+        runOutputs, nextState = table[inputName][
+            stateIDs[inState.method.__name__]]
+        testCase.assertEqual(nextState, stateIDs[outState.method.__name__])
+    testCase.assertEqual(set(table), inputNames)
+    testCase.assertEqual(
+        sum(entry is not None for row in table.values() for entry in row),
+        len(transitions))
+
+    class RecordsTransitions(machineClass):
+
+        def _transition(self, inputName):
+            self.transitions.append(inputName)
+            return lambda *args: None
+
+    for inputName in inputNames:
+        # an input without a hand-written method would be automat's
+        # own, and would track its state apart from the table
+        testCase.assertTrue(
+            inspect.isfunction(machineClass.__dict__[inputName]),
+            inputName)
+        instance = RecordsTransitions(None)
+        instance.transitions = []
+        getattr(instance, inputName)(*inputArguments.get(inputName, ()))
+        testCase.assertEqual(instance.transitions, [inputName])
+
+
 class SockJSProtocolMachineTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -366,6 +468,34 @@ class SockJSProtocolMachineTestCase(unittest.TestCase):
         with self.assertRaises((KeyError, automat.NoTransition)):
             self.sockJSMachine.connect(self.sockJSWireProtocol)
 
+    def test_notConnected(self):
+        '''A SockJSProtocolMachine cannot write, receive or heartbeat before
+        it has connected or after it has disconnected.
+
+        '''
+        def assertNoTransitions(stateName):
+            with self.assertRaises(automat.NoTransition) as cm:
+                self.sockJSMachine.write([1])
+            self.assertEqual(cm.exception.state, stateName)
+            self.assertEqual(cm.exception.symbol, 'write')
+            with self.assertRaises(automat.NoTransition) as cm:
+                self.sockJSMachine.writeSequence([[1]])
+            self.assertEqual(cm.exception.state, stateName)
+            with self.assertRaises(automat.NoTransition) as cm:
+                self.sockJSMachine.receive([1])
+            self.assertEqual(cm.exception.state, stateName)
+            with self.assertRaises(automat.NoTransition) as cm:
+                self.sockJSMachine.heartbeat()
+            self.assertEqual(cm.exception.state, stateName)
+
+        assertNoTransitions('notYetConnected')
+        self.sockJSMachine.connect(self.sockJSWireProtocol)
+        self.sockJSMachine.disconnect()
+        assertNoTransitions('disconnected')
+
+        self.assertEqual(self.protocolRecorder.wroteData, [])
+        self.assertEqual(self.protocolRecorder.wroteHeartbeat, 0)
+
     def test_connect(self):
         '''SockJSProtocolMachine.connect writes an opening frame and schedules
         a heartbeat.
@@ -387,6 +517,20 @@ class SockJSProtocolMachineTestCase(unittest.TestCase):
         self.assertEqual(self.protocolRecorder.wroteData, [[1, 'something']])
         self.assertEqual(self.heartbeatRecorder.scheduleCalls, 2)
 
+    def test_writeSequence(self):
+        '''SockJSProtocolMachine.writeSequence writes a sequence of
+        array-like things as a single frame and (re)schedules a
+        heartbeat once.  An empty sequence writes nothing.
+
+        '''
+        self.sockJSMachine.connect(self.sockJSWireProtocol)
+        self.sockJSMachine.writeSequence([[1], ['something', 2]])
+        self.sockJSMachine.writeSequence([[], []])
+
+        self.assertEqual(self.protocolRecorder.wroteData,
+                         [[1, 'something', 2]])
+        self.assertEqual(self.heartbeatRecorder.scheduleCalls, 2)
+
     def test_heartbeat(self):
         '''SockJSProtocolMachine.heartbeat writes a heartbeat!'''
         self.sockJSMachine.connect(self.sockJSWireProtocol)
@@ -434,6 +578,15 @@ class SockJSProtocolMachineTestCase(unittest.TestCase):
 
         self.assertEqual(self.heartbeatRecorder.stopCalls, 1)
 
+    def test_transitionsMatchMachine(self):
+        '''_TRANSITIONS holds the transitions declared to automat, and
+        SockJSProtocolMachine's inputs dispatch through it.
+
+        '''
+        assertDispatchMatchesMachine(self, P.SockJSProtocolMachine,
+                                     P._TRANSITIONS, P._STATE_IDS,
+                                     {'connect': (None,)})
+
     def test_close(self):
         '''SockJSProtocolMachine.close implements a passive close: it drops
         the transport and cancels any pending heartbeats.
@@ -448,16 +601,20 @@ class SockJSProtocolMachineTestCase(unittest.TestCase):
 
 
 class RecordsProtocolMachineActions(object):
+    __slots__ = ('connect', 'received', 'written', 'writtenSequences',
+                 'disconnected', 'closed')
 
     def __init__(self):
         self.connect = []
         self.received = []
         self.written = []
+        self.writtenSequences = []
         self.disconnected = 0
         self.closed = 0
 
 
 class FakeSockJSProtocolMachine(object):
+    __slots__ = ('_recorder',)
 
     def __init__(self, recorder):
         self._recorder = recorder
@@ -472,6 +629,9 @@ class FakeSockJSProtocolMachine(object):
     def write(self, data):
         self._recorder.written.append(data)
 
+    def writeSequence(self, data):
+        self._recorder.writtenSequences.append(data)
+
     def disconnect(self):
         self._recorder.disconnected += 1
 
@@ -493,7 +653,7 @@ class SockJSProtocolTestCase(unittest.TestCase):
 
         self.factory.stateMachineFactory = fakeStateMachineFactory
 
-        self.address = IPv4Address('TCP', '127.0.0.1', 80)
+        self.address = ADDRESS
         self.transport = StringTransport()
 
         self.protocol = self.factory.buildProtocol(self.address)
@@ -504,29 +664,40 @@ class SockJSProtocolTestCase(unittest.TestCase):
         self.assertEqual(self.stateMachineRecorder.connect, [self.transport])
 
     def test_dataReceived_write(self):
-        '''dataReceived passes the data to the state machine's receive method
-        and the wrapped protocol.  With our echo protocol, we also
-        test that write() calls the machine's write method.
+        '''Once connected, dataReceived passes the data straight to the
+        wrapped protocol.  With our echo protocol, we also test that
+        write() calls the machine's write method.
 
         '''
         self.protocol.dataReceived(b'"something"')
-        self.assertEqual(self.stateMachineRecorder.received,
-                         [b'"something"'])
+        self.assertEqual(self.stateMachineRecorder.received, [])
         self.assertEqual(self.stateMachineRecorder.written,
                          [b'"something"'])
 
     def test_dataReceived_writeSequence(self):
-        '''dataReceived passes the data to the state machine's receive method
-        and the wrapped protocol.  With our echo protocol, we also
-        test that writeSequence() calls the machine's write method.
+        '''Once connected, dataReceived passes the data straight to the
+        wrapped protocol.  With our echo protocol, we also test that
+        writeSequence() calls the machine's writeSequence method.
 
         '''
         self.protocol.dataReceived([b'"x"', b'"y"'])
-        self.assertEqual(self.stateMachineRecorder.received,
+        self.assertEqual(self.stateMachineRecorder.received, [])
+        # a single writeSequence call
+        self.assertEqual(self.stateMachineRecorder.written, [])
+        self.assertEqual(self.stateMachineRecorder.writtenSequences,
                          [[b'"x"', b'"y"']])
-        # multiple write calls
+
+    def test_dataReceived_afterLoseConnection(self):
+        '''After loseConnection, dataReceived passes the data to the state
+        machine's receive method before the wrapped protocol.
+
+        '''
+        self.protocol.loseConnection()
+        self.protocol.dataReceived(b'"something"')
+        self.assertEqual(self.stateMachineRecorder.received,
+                         [b'"something"'])
         self.assertEqual(self.stateMachineRecorder.written,
-                         [b'"x"', b'"y"'])
+                         [b'"something"'])
 
     def test_loseConnection(self):
         '''loseConnection calls the state machine's disconnect method.'''
@@ -545,6 +716,12 @@ class SockJSProtocolTestCase(unittest.TestCase):
 
 
 class RecordsRequestSessionActions(object):
+    __slots__ = ('request', 'connectionsEstablished', 'connectionsCompleted',
+                 'requestsBegun', 'receivedData', 'dataReceived',
+                 'completelyWritten', 'otherRequestsClosed',
+                 'rawFramesWritten', 'heartbeatsCompleted',
+                 'currentRequestsFinished', 'connectionsLostCompletely',
+                 'connectionsCompletelyLost', 'connectionsMadeFromRequest')
 
     def __init__(self):
         self.request = None
@@ -558,7 +735,7 @@ class RecordsRequestSessionActions(object):
 
         self.completelyWritten = []
         self.otherRequestsClosed = []
-        self.dataWritten = []
+        self.rawFramesWritten = []
         self.heartbeatsCompleted = 0
         self.currentRequestsFinished = 0
         self.connectionsLostCompletely = 0
@@ -567,6 +744,7 @@ class RecordsRequestSessionActions(object):
 
 
 class FakeRequestSessionProtocolWrapper(object):
+    __slots__ = ('recorder', 'terminationDeferred')
 
     def __init__(self, recorder):
         self.recorder = recorder
@@ -601,8 +779,11 @@ class FakeRequestSessionProtocolWrapper(object):
     def dataReceived(self, data):
         self.recorder.receivedData.append(data)
 
-    def writeData(self, data):
-        self.recorder.dataWritten.append(data)
+    def encodeData(self, data):
+        return P.sockJSJSON(data)[1:-1]
+
+    def writeRawFrame(self, frame):
+        self.recorder.rawFramesWritten.append(frame)
 
     def completeWrite(self, data):
         self.recorder.completelyWritten.append(data)
@@ -659,6 +840,18 @@ class RequestSessionMachineTestCase(unittest.TestCase):
         self.assertEqual(self.recorder.requestsBegun, 1)
         self.assertEqual(self.recorder.connectionsCompleted, 1)
 
+    def test_noTransition(self):
+        '''Inputs that have no transition from the current state raise
+        automat.NoTransition and leave the state unchanged.
+
+        '''
+        with self.assertRaises(automat.NoTransition) as cm:
+            self.requestSessionMachine.write([1])
+        self.assertEqual(str(cm.exception),
+                         'no transition for write in neverConnected')
+        self.requestSessionMachine.attach(self.request)
+        self.assertIs(self.recorder.request, self.request)
+
     def test_connectedHaveTransportWrite(self):
         '''With an attached request, write calls completeWrite and does not
         buffer.
@@ -812,18 +1005,21 @@ class RequestSessionMachineTestCase(unittest.TestCase):
 
         self.requestSessionMachine.write(unserializedMessage)
         self.requestSessionMachine.write(unserializedMessage)
+        # buffered writes are serialized as they arrive
         self.assertEqual(self.requestSessionMachine.buffer,
-                         unserializedMessage * 2)
+                         [b'"I wasn\'t serialized"'] * 2)
 
         newRequest = DummyRequestAllowsNonBytes([b'newRequest'])
 
         self.requestSessionMachine.attach(newRequest)
         self.assertEqual(self.requestSessionMachine.buffer, [])
 
-        # the two lists have been concatenated into one, and were
-        # flushed with a single call to requestSession.writeData
-        self.assertEqual(self.recorder.dataWritten,
-                         [unserializedMessage * 2])
+        # the two lists have been concatenated into one frame, and
+        # were flushed with a single call to
+        # requestSession.writeRawFrame
+        self.assertEqual(
+            self.recorder.rawFramesWritten,
+            [b'a["I wasn\'t serialized","I wasn\'t serialized"]'])
 
     def test_connectedNoTransportPendingReceive(self):
         '''Received data passes immediately to the wrapped protocol, even when
@@ -832,7 +1028,7 @@ class RequestSessionMachineTestCase(unittest.TestCase):
         '''
         self.test_firstAttach()
         self.requestSessionMachine.detach()
-        self.requestSessionMachine.write(b'abc')
+        self.requestSessionMachine.write(['abc'])
         self.requestSessionMachine.receive(b'xyz')
         self.assertEqual(self.recorder.dataReceived, [b'xyz'])
 
@@ -843,7 +1039,7 @@ class RequestSessionMachineTestCase(unittest.TestCase):
         '''
         self.test_firstAttach()
         self.requestSessionMachine.detach()
-        self.requestSessionMachine.write(b'abc')
+        self.requestSessionMachine.write(['abc'])
         self.requestSessionMachine.heartbeat()
         self.assertEqual(self.recorder.heartbeatsCompleted, 0)
 
@@ -854,7 +1050,7 @@ class RequestSessionMachineTestCase(unittest.TestCase):
         '''
         self.test_firstAttach()
         self.requestSessionMachine.detach()
-        self.requestSessionMachine.write(b'abc')
+        self.requestSessionMachine.write(['abc'])
         self.requestSessionMachine.writeClose(P.DISCONNECT.GO_AWAY)
         self.requestSessionMachine.loseConnection()
 
@@ -875,6 +1071,20 @@ class RequestSessionMachineTestCase(unittest.TestCase):
         failure = self.recorder.connectionsCompletelyLost[0]
         failure.trap(P.SessionTimeout)
 
+    def test_transitionsMatchMachine(self):
+        '''_REQUEST_SESSION_TRANSITIONS holds the transitions declared to
+        automat, and RequestSessionMachine's inputs dispatch through
+        it.
+
+        '''
+        assertDispatchMatchesMachine(
+            self, P.RequestSessionMachine,
+            P._REQUEST_SESSION_TRANSITIONS, P._REQUEST_SESSION_STATE_IDS,
+            {'attach': (None,),
+             'write': ([],),
+             'receive': ([],),
+             'writeClose': (None,)})
+
 
 class TimeoutClockTestCase(unittest.TestCase):
 
@@ -919,19 +1129,50 @@ class TimeoutClockTestCase(unittest.TestCase):
         return self.timeoutDeferred
 
     def test_reset_interrupts(self):
-        '''A reset() call will remove the pending timeout, so that a
-        subsequent start() call reschedule it.
+        '''A reset() call will disarm the pending timeout, so that it
+        does not expire the connection, until a subsequent start()
+        call rearms it.
 
         '''
+        expirations = []
+        self.timeoutDeferred.addCallback(expirations.append)
+
         self.timeoutClock.start()
 
         pendingExpiration = self.timeoutClock.timeoutCall
         self.assertEqual(self.clock.getDelayedCalls(), [pendingExpiration])
 
         self.timeoutClock.reset()
+        self.clock.advance(self.length * 2)
+
+        self.assertFalse(expirations)
+        self.assertIsNone(self.timeoutClock.timeoutCall)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        self.timeoutClock.start()
+        self.clock.advance(self.length)
+        self.assertEqual(expirations, [P.TimeoutClock.EXPIRED])
+
+    def test_reset_postpones(self):
+        '''A start() call after a reset() call starts the timeout over
+        without scheduling a second call.
+
+        '''
+        expirations = []
+        self.timeoutDeferred.addCallback(expirations.append)
+
+        self.timeoutClock.start()
+        self.clock.advance(self.length - 1)
+        self.timeoutClock.reset()
+        self.timeoutClock.start()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(1)
+        self.assertFalse(expirations)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
 
-        resetPendingExecution = self.timeoutClock.timeoutCall
-        self.assertIsNot(pendingExpiration, resetPendingExecution)
+        self.clock.advance(self.length - 1)
+        self.assertEqual(expirations, [P.TimeoutClock.EXPIRED])
         self.assertEqual(self.clock.getDelayedCalls(), [])
 
     def test_stop(self):
@@ -957,6 +1198,7 @@ class RecordsTimeoutClockActions(object):
 
 
 class FakeTimeoutClock(object):
+    __slots__ = ('recorder',)
 
     def __init__(self, recorder):
         self.recorder = recorder
@@ -972,6 +1214,9 @@ class FakeTimeoutClock(object):
 
 
 class RecordsSessionMachineActions(object):
+    __slots__ = ('attachedRequests', 'detachCalls', 'dataWritten',
+                 'receivedData', 'closeReasonsWritten', 'heartbeatCalls',
+                 'loseConnectionCalls', 'connectionsLostReasons')
 
     def __init__(self):
         self.attachedRequests = []
@@ -985,34 +1230,28 @@ class RecordsSessionMachineActions(object):
 
 
 class FakeRequestSessionMachine(object):
+    __slots__ = ('recorder', 'attach', 'write', 'receive', 'writeClose',
+                 'connectionLost')
 
     def __init__(self, recorder):
         self.recorder = recorder
-
-    def attach(self, request):
-        self.recorder.attachedRequests.append(request)
+        # inputs that only record their argument are the recorder's
+        # list appends
+        self.attach = recorder.attachedRequests.append
+        self.write = recorder.dataWritten.append
+        self.receive = recorder.receivedData.append
+        self.writeClose = recorder.closeReasonsWritten.append
+        self.connectionLost = recorder.connectionsLostReasons.append
 
     def detach(self):
         self.recorder.detachCalls += 1
 
-    def write(self, data):
-        self.recorder.dataWritten.append(data)
-
-    def receive(self, data):
-        self.recorder.receivedData.append(data)
-
-    def writeClose(self, reason):
-        self.recorder.closeReasonsWritten.append(reason)
-
     def heartbeat(self):
         self.recorder.heartbeatCalls += 1
 
     def loseConnection(self):
         self.recorder.loseConnectionCalls += 1
 
-    def connectionLost(self, reason):
-        self.recorder.connectionsLostReasons.append(reason)
-
 
 class RequestSessionProtocolWrapperTestCase(unittest.TestCase):
     '''Tests for the ProtocolWrapper that adapts a
@@ -1041,7 +1280,7 @@ class RequestSessionProtocolWrapperTestCase(unittest.TestCase):
         self.factory.timeoutClockFactory = self.fakeTimeoutClockFactory
         self.factory.sessionMachineFactory = self.fakeSessionMachineFactory
 
-        self.address = IPv4Address('TCP', '127.0.0.1', 80)
+        self.address = ADDRESS
         self.protocol = self.factory.buildProtocol(self.address)
         self.request = DummyRequest([b'ignored'])
 
@@ -1099,6 +1338,22 @@ class RequestSessionProtocolWrapperTestCase(unittest.TestCase):
         self.protocol.write(b'something')
         self.assertEqual(self.request.written, [b'something\n'])
 
+    def test_encodeData(self):
+        '''encodeData serializes the elements of an array-like thing
+        without the enclosing brackets.
+
+        '''
+        self.assertEqual(self.protocol.encodeData(["a", 1]), b'"a",1')
+
+    def test_writeRawFrame(self):
+        '''writeRawFrame writes an already serialized frame to the current
+        request.
+
+        '''
+        self.protocol.request = self.request
+        self.protocol.writeRawFrame(b'a["a"]')
+        self.assertEqual(self.request.written, [b'a["a"]\n'])
+
     def test_closeOtherRequest(self):
         '''closeOtherRequest writes a close frame consisting of a reason and a
         newline to a request.
@@ -1107,6 +1362,15 @@ class RequestSessionProtocolWrapperTestCase(unittest.TestCase):
         self.protocol.closeOtherRequest(self.request, P.DISCONNECT.GO_AWAY)
         self.assertEqual(self.request.written, [b'c[3000,"Go away!"]\n'])
 
+    def test_closeLinesPrecomputed(self):
+        '''The newline-terminated close frames are built once per
+        factory.
+
+        '''
+        self.assertEqual(self.protocol.closeLines[P.DISCONNECT.STILL_OPEN],
+                         b'c[2010,"Another connection still open"]\n')
+        self.assertIs(self.protocol.closeLines, self.factory.closeLines)
+
     def test_dataReceived(self):
         '''dataReceived passes the data off to the session state machine.
 
@@ -1215,24 +1479,19 @@ class RequestSessionProtocolWrapperTestCase(unittest.TestCase):
         self.protocol.beginRequest()
 
         reason = connectionDone
-
-        def assertConnectionLostCalled(ignored):
-            recordedExceptions = [
-                reason.value for reason in
-                self.sessionMachineRecorder.connectionsLostReasons]
-            self.assertEqual(recordedExceptions, [reason.value])
-
         finishedNotifier = self.protocol.finishedNotifier
-        finishedNotifier.addCallback(assertConnectionLostCalled)
-
-        def trapConnectionDone(failure):
-            failure.trap(error.ConnectionDone)
-
         terminationDeferred = self.protocol.terminationDeferred
-        terminationDeferred.addErrback(trapConnectionDone)
 
+        # both Deferreds fire synchronously
         self.request.processingFailed(reason)
-        return DeferredList([finishedNotifier, terminationDeferred])
+
+        self.assertIsNone(self.successResultOf(finishedNotifier))
+        recordedExceptions = [
+            reason.value for reason in
+            self.sessionMachineRecorder.connectionsLostReasons]
+        self.assertEqual(recordedExceptions, [reason.value])
+
+        self.failureResultOf(terminationDeferred, error.ConnectionDone)
 
     def test_beginRequest_finishedNotifier_traps_cancellation(self):
         '''Beginning a request retrieves a Deferred from the request that
@@ -1288,6 +1547,64 @@ class RequestSessionProtocolWrapperTestCase(unittest.TestCase):
         self.assertTrue(IStubTransport.providedBy(self.protocol))
         self.assertFalse(self.protocol.wrappedProtocol.connectionMadeCalls)
 
+    def test_establishConnection_directlyProvides(self):
+        '''Establishing a connection makes the
+        RequestSessionProtocolWrapper instance provide the interfaces
+        that the request's transport directly provides, as well as
+        those its class implements, even when another instance of
+        that class has been seen before.
+
+        '''
+        class IStubTransport(Interface):
+            pass
+
+        class IStartedTLS(Interface):
+            pass
+
+        @implementer(IStubTransport)
+        class StubTransport:
+            pass
+
+        # see test_establishConnection
+        implementedBy(P.RequestSessionProtocolWrapper)
+
+        # populate the per-class cache
+        self.assertFalse(P._transportInterfaces(
+            StubTransport()).isOrExtends(IStartedTLS))
+
+        self.request.transport = StubTransport()
+        directlyProvides(self.request.transport, IStartedTLS)
+        self.protocol.establishConnection(self.request)
+        self.assertTrue(IStubTransport.providedBy(self.protocol))
+        self.assertTrue(IStartedTLS.providedBy(self.protocol))
+
+    def test_transportInterfaces_classicClasses(self):
+        '''The interfaces looked up for a transport are those of its own
+        class, even for instances of Python 2's classic classes, which
+        all share one type.
+
+        '''
+        class IFirstTransport(Interface):
+            pass
+
+        class ISecondTransport(Interface):
+            pass
+
+        @implementer(IFirstTransport)
+        class FirstTransport:
+            pass
+
+        @implementer(ISecondTransport)
+        class SecondTransport:
+            pass
+
+        first = P._transportInterfaces(FirstTransport())
+        second = P._transportInterfaces(SecondTransport())
+        self.assertTrue(first.isOrExtends(IFirstTransport))
+        self.assertFalse(first.isOrExtends(ISecondTransport))
+        self.assertTrue(second.isOrExtends(ISecondTransport))
+        self.assertFalse(second.isOrExtends(IFirstTransport))
+
     def test_completeConnection(self):
         '''Completing a connection attaches the RequestSessionProtocolWrapper
         instance to the wrapped protocol as the wrapped protocol's
@@ -1319,6 +1636,15 @@ class RequestSessionProtocolWrapperTestCase(unittest.TestCase):
         self.protocol.completeHeartbeat()
         self.assertEqual(self.request.written, [b'h\n'])
 
+    def test_writeOpen(self):
+        '''writeOpen writes a newline-terminated open frame to the
+        request.
+
+        '''
+        self.protocol.request = self.request
+        self.protocol.writeOpen()
+        self.assertEqual(self.request.written, [b'o\n'])
+
     def test_completeConnectionLost(self):
         '''Completing a lost connection calls the wrapped protocol's
         connectionLost.
@@ -1406,6 +1732,18 @@ class SessionHouseTestCase(unittest.TestCase):
             self.sessions.validateAndExtractSessionID(self.request),
             b'session')
 
+    def test_validateAndExtraSessionID_eachSegment(self):
+        '''Every path segment must be non-empty and free of dots, and
+        nothing else is required of them.
+
+        '''
+        validate = self.sessions.validateAndExtractSessionID
+        self.assertIsNone(validate(DummyRequest([b'server', b'', b'xhr'])))
+        self.assertIsNone(validate(DummyRequest([b'.', b'session', b'xhr'])))
+        self.assertIsNone(validate(DummyRequest([b'server', b'a.b', b'xhr'])))
+        self.assertEqual(validate(DummyRequest([b'1', b'a\nb', b'xhr'])),
+                         b'a\nb')
+
     def test_attachToSession_returns_False(self):
         '''attachToSession returns False if a request with invalid IDs
         attempts to attaches to a session.
@@ -1443,6 +1781,20 @@ class SessionHouseTestCase(unittest.TestCase):
         self.assertNotIn(self.sessionID, self.sessions.sessions)
         return self.protocol.terminationDeferred
 
+    def test_sessionClosed_unexpected_errback(self):
+        '''Errbacking the protocol's terminationDeferred with an unexpected
+        failure removes the session from the house but passes the
+        failure on.
+
+        '''
+        self.test_attachToSession_new_session()
+        terminationDeferred = Deferred()
+        terminationDeferred.addBoth(self.sessions._sessionClosed,
+                                    self.sessionID)
+        terminationDeferred.errback(ZeroDivisionError())
+        self.assertNotIn(self.sessionID, self.sessions.sessions)
+        self.failureResultOf(terminationDeferred, ZeroDivisionError)
+
     def test_attachToSession_existing_session(self):
         '''attachToSession returns the existing session when given a request
         with a duplicate and valid session ID.
@@ -1484,33 +1836,116 @@ class SessionHouseTestCase(unittest.TestCase):
 class XHRSessionTestCase(RequestSessionProtocolWrapperTestCase):
 
     def makeFactory(self):
-        return P.XHRSessionFactory(self.wrappedFactory)
+        self.clock = Clock()
+        return P.XHRSessionFactory(self.wrappedFactory, clock=self.clock)
 
     def test_writeOpen(self):
-        '''XHRSession detaches the request immediately after writing an open
-        frame.
-
-        '''
+        '''XHRSession detaches the request after writing an open frame.'''
         self.protocol.request = self.request
         self.protocol.writeOpen()
+        self.clock.advance(0)
         self.assertEqual(self.sessionMachineRecorder.detachCalls, 1)
 
     def test_writeData(self):
-        '''XHRSession detaches the request immediately after writing any
-        data frame.
+        '''XHRSession detaches the request after writing any data frame.'''
+        self.protocol.request = self.request
+        self.protocol.writeData(['ignored'])
+        self.clock.advance(0)
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 1)
+
+    def test_writeRawFrame(self):
+        '''XHRSession detaches the request after writing a serialized
+        frame, such as a flushed buffer.
 
         '''
         self.protocol.request = self.request
-        self.protocol.writeData(['ignored'])
+        self.protocol.writeRawFrame(b'a["ignored"]')
+        self.assertEqual(self.request.written, [b'a["ignored"]\n'])
+        self.clock.advance(0)
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 1)
+
+    def test_detachFromRequest(self):
+        '''XHRSession has the session state machine perform the detach on
+        the next reactor iteration.
+
+        '''
+        self.protocol.request = self.request
+        self.protocol.detachFromRequest()
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 0)
+        self.clock.advance(0)
         self.assertEqual(self.sessionMachineRecorder.detachCalls, 1)
 
+    def test_writeWhileDetachedThenAttach(self):
+        '''A write while detached schedules nothing, so a request that
+        attaches and has the buffer flushed to it during the same
+        reactor iteration is still detached on the next one.
+
+        '''
+        self.protocol.writeData(['buffered'])
+        self.assertFalse(self.clock.getDelayedCalls())
+
+        self.protocol.request = self.request
+        self.protocol.writeRawFrame(b'a["buffered"]')
+        self.clock.advance(0)
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 1)
+
+    def test_detachFromReplacedRequest(self):
+        '''A detach scheduled for a request that's been replaced during
+        the same reactor iteration is rescheduled for the new request.
+
+        '''
+        self.protocol.request = self.request
+        self.protocol.detachFromRequest()
+
+        self.protocol.request = DummyRequest([b'another'])
+        self.protocol.detachFromRequest()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(0)
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 1)
+
+    def test_detachFromRequest_coalesces(self):
+        '''XHRSession detaches the request on the next reactor iteration,
+        and only once no matter how many frames it wrote.
+
+        '''
+        self.protocol.request = self.request
+        self.protocol.writeData(['first'])
+        self.protocol.writeData(['second'])
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 0)
+
+        self.clock.advance(0)
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 1)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_detachFromRequest_requestReplaced(self):
+        '''A pending detach does not detach a request other than the one
+        that was current when it was scheduled.
+
+        '''
+        self.protocol.request = self.request
+        self.protocol.detachFromRequest()
+        self.protocol.request = DummyRequest([b'another'])
+
+        self.clock.advance(0)
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 0)
+
+    def test_connectionLost_cancelsDetach(self):
+        '''Losing the connection cancels a pending detach.'''
+        self.protocol.request = self.request
+        self.protocol.detachFromRequest()
+        self.protocol.connectionLost(connectionDone)
+        self.assertFalse(self.clock.getDelayedCalls())
+
 
 class XHRStreamingSessionTestCase(RequestSessionProtocolWrapperTestCase):
     maximumBytes = 128
 
     def makeFactory(self):
+        self.clock = Clock()
         return P.XHRStreamingSessionFactory(maximumBytes=self.maximumBytes,
-                                            wrappedFactory=self.wrappedFactory)
+                                            wrappedFactory=self.wrappedFactory,
+                                            clock=self.clock)
 
     def test_writeOpen(self):
         '''XHRStreamingSession writes a large prelude when establishing a
@@ -1519,10 +1954,41 @@ class XHRStreamingSessionTestCase(RequestSessionProtocolWrapperTestCase):
         '''
         self.protocol.request = self.request
         self.protocol.writeOpen()
-        self.assertEqual(self.request.written, [b'h' * 2048 + b'\n',
-                                                b'o\n'])
+        self.assertEqual(self.request.written,
+                         [b'h' * 2048 + b'\n' + b'o\n'])
         self.assertEqual(self.sessionMachineRecorder.detachCalls, 0)
 
+    def test_writeOpen_customPrelude(self):
+        '''writeOpen writes the session's prelude, so subclasses and
+        instances can replace it.
+
+        '''
+        self.protocol.request = self.request
+        self.protocol.prelude = b'short'
+        self.protocol.writeOpen()
+        self.assertEqual(self.request.written, [b'short\no\n'])
+
+    def test_write(self):
+        '''write adds a newline and writes the data to the current
+        request on the next reactor iteration.
+
+        '''
+        self.protocol.request = self.request
+        self.protocol.write(b'something')
+        self.assertEqual(self.request.written, [])
+        self.clock.advance(0)
+        self.assertEqual(self.request.written, [b'something\n'])
+
+    def test_completeHeartbeat(self):
+        '''Completing a heartbeat writes it to the request on the next
+        reactor iteration.
+
+        '''
+        self.protocol.request = self.request
+        self.protocol.completeHeartbeat()
+        self.clock.advance(0)
+        self.assertEqual(self.request.written, [b'h\n'])
+
     def test_completeWrite(self):
         '''XHRStreamingSession detaches the request after writing at least
         maximumBytes.
@@ -1531,11 +1997,71 @@ class XHRStreamingSessionTestCase(RequestSessionProtocolWrapperTestCase):
         self.protocol.request = self.request
 
         self.protocol.completeWrite(['ignored'])
+        self.clock.advance(0)
         self.assertEqual(self.sessionMachineRecorder.detachCalls, 0)
 
         self.protocol.completeWrite(['ignored' * self.maximumBytes])
+        self.clock.advance(0)
         self.assertEqual(self.sessionMachineRecorder.detachCalls, 1)
 
+    def test_writeRawFrame(self):
+        '''XHRStreamingSession counts serialized frames towards
+        maximumBytes.
+
+        '''
+        self.protocol.request = self.request
+
+        self.protocol.writeRawFrame(b'a["ignored"]')
+        self.clock.advance(0)
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 0)
+
+        self.protocol.writeRawFrame(b'a' * self.maximumBytes)
+        self.clock.advance(0)
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 1)
+
+    def test_batchedWrites(self):
+        '''Everything written during one reactor iteration goes out as a
+        single chunk, in order, and counts towards maximumBytes once.
+
+        '''
+        self.protocol.request = self.request
+
+        self.protocol.completeWrite([1])
+        self.protocol.completeHeartbeat()
+        self.protocol.writeRawFrame(b'a' * (self.maximumBytes - 8))
+        self.assertEqual(self.request.written, [])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(0)
+        self.assertEqual(
+            self.request.written,
+            [b'a[1]\nh\n' + b'a' * (self.maximumBytes - 8) + b'\n'])
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 1)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_finishCurrentRequest_flushes(self):
+        '''Finishing the current request writes any pending frames to it
+        first.
+
+        '''
+        self.protocol.request = self.request
+        self.protocol.completeWrite([1])
+
+        self.protocol.finishCurrentRequest()
+        self.assertEqual(self.request.written, [b'a[1]\n'])
+        self.assertEqual(self.request.finished, 1)
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.assertEqual(self.sessionMachineRecorder.detachCalls, 0)
+
+    def test_connectionLost_discardsPending(self):
+        '''Losing the connection discards pending frames.'''
+        self.protocol.request = self.request
+        self.protocol.completeWrite([1])
+
+        self.protocol.connectionLost()
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.assertEqual(self.request.written, [])
+
 
 class WebSocketProtocolWrapperTestCase(SockJSWireProtocolWrapperTestCase):
 
@@ -1578,9 +2104,32 @@ class WebSocketServerProtocolTestCase(unittest.TestCase):
 
         self.factory = P.WebSocketSessionFactory(self.wrappedFactory)
 
-        self.address = IPv4Address('TCP', '127.0.0.1', 80)
+        self.address = ADDRESS
         self.protocol = self.factory.buildProtocol(self.address)
 
+    def test_buildProtocol(self):
+        '''buildProtocol wires the protocol to its factory and to the
+        wrapped protocol built for the same address.
+
+        '''
+        self.assertIs(self.protocol.factory, self.factory)
+        self.assertIs(self.protocol._proto.wrappedProtocol,
+                      self.wrappedProtocol)
+        self.assertIs(self.protocol._proto.transport, self.protocol)
+
+    def test_sharedWrappingFactory(self):
+        '''WebSocketSessionFactories for the same wrapped factory share
+        one WebSocketWrappingFactory.
+
+        '''
+        other = P.WebSocketSessionFactory(self.wrappedFactory)
+        self.assertIs(other._factory, self.factory._factory)
+        self.assertIs(other._factory.wrappedFactory, self.wrappedFactory)
+
+        unrelated = P.WebSocketSessionFactory(
+            RecordingProtocolFactory([], []))
+        self.assertIsNot(unrelated._factory, self.factory._factory)
+
     def makeFakeRequest(self):
         '''This is laborious enough to warrant its own shortcut.'''
         return A.ConnectionRequest(peer='ignored',
@@ -1594,22 +2143,31 @@ class WebSocketServerProtocolTestCase(unittest.TestCase):
                                    extensions=[])
 
     def test_onConnect_text(self):
-        '''onConnect sets _binaryMode to True iff one of the protocols has
-        'binary' in it.
+        '''onConnect sets _binaryMode to True iff one of the protocols is
+        'binary'.
         '''
         notBinary = self.makeFakeRequest()
         self.protocol.onConnect(notBinary)
         self.assertFalse(self.protocol._binaryMode)
 
     def test_onConnect_binary(self):
-        '''onConnect sets _binaryMode to True iff one of the protocols has
-        'binary' in it.
+        '''onConnect sets _binaryMode to True iff one of the protocols is
+        'binary'.
         '''
         binary = self.makeFakeRequest()
         binary.protocols.append(b'binary')
         self.protocol.onConnect(binary)
         self.assertTrue(self.protocol._binaryMode)
 
+    def test_onConnect_binary_text(self):
+        '''onConnect recognizes the 'binary' protocol when autobahn
+        provides it as text.
+        '''
+        binary = self.makeFakeRequest()
+        binary.protocols.append(u'binary')
+        self.protocol.onConnect(binary)
+        self.assertTrue(self.protocol._binaryMode)
+
     def test_onOpen(self):
         '''onOpen calls the underlying protocol's makeConnection method with
         _WebSocketServerProtocol instance as the transport.
@@ -1675,3 +2233,24 @@ class WebSocketServerProtocolTestCase(unittest.TestCase):
         self.assertEqual(self.receivedData, [])
         self.assertEqual(failedConnectionReasons, [
             self.protocol.CLOSE_STATUS_CODE_UNSUPPORTED_DATA])
+
+    def test_onMessage_binary_succeeds(self):
+        '''In binary mode, binary messages reach the underlying protocol.'''
+        self.test_onConnect_binary()
+        self.protocol.onMessage(b'["some data"]', isBinary=True)
+        self.assertEqual(self.receivedData, [['some data']])
+
+    def test_onMessage_text_disagreement(self):
+        '''In text mode, a binary message fails the connection.'''
+        failedConnectionReasons = []
+
+        def recordFailConnection(reason, message):
+            failedConnectionReasons.append(reason)
+
+        self.test_onConnect_text()
+        self.protocol.failConnection = recordFailConnection
+
+        self.protocol.onMessage(b'["some data"]', isBinary=True)
+        self.assertEqual(self.receivedData, [])
+        self.assertEqual(failedConnectionReasons, [
+            self.protocol.CLOSE_STATUS_CODE_UNSUPPORTED_DATA])